@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 import argparse
+import contextlib
+import mmap
+import os
+import stat
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy import interpolate as interpolate
 
 ##################################################
@@ -76,197 +81,325 @@ def get_user_args():
     return parser
 ##################################################
 
+# read in a single file and return its columns as numpy arrays
+def read_in_file(f, e='n'):
+    """Reads in two or three space separated columns from one data file.
+        Returns a tuple of float64 numpy arrays holding the x, y and error values.
+        The latter is only read if the argument e='y', otherwise it is zero"""
+    # commas become spaces and '@' comments become '#' comments, so the
+    # rows are cleaned in a single pass and the parser skips comments itself
+    table = bytes.maketrans(b',@', b' #')
+
+    with open(f, 'rb') as F:
+        # map regular files rather than reading them into memory. Pipes
+        # and empty files cannot be mapped, so read those line by line
+        info = os.fstat(F.fileno())
+        if stat.S_ISREG(info.st_mode) and info.st_size > 0:
+            src = mmap.mmap(F.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            src = contextlib.nullcontext(F)
+
+        # hand the rows straight to the parser. Only the columns that are
+        # used get parsed, so the array is no bigger than the plot needs.
+        # A pipe cannot be read twice, so there every column is parsed
+        # and a missing error column is noticed afterwards
+        if e != 'y':
+            cols = (0,1)
+        else:
+            cols = (0,1,2) if F.seekable() else None
+        with src as rd:
+            try:
+                rows = iter(rd.readline, b'')
+                data = np.loadtxt( (row.translate(table) for row in rows),
+                                   comments='#', usecols=cols, ndmin=2 )
+            except ValueError:
+                if cols != (0,1,2):
+                    raise
+                # no error column provided, read x and y only
+                rd.seek(0)
+                rows = iter(rd.readline, b'')
+                data = np.loadtxt( (row.translate(table) for row in rows),
+                                   comments='#', usecols=(0,1), ndmin=2 )
+
+    if data.shape[1] > 2:
+        return data[:,0], data[:,1], data[:,2]
+    # if no error column provided, just set to zero
+    return data[:,0], data[:,1], np.zeros(data.shape[0])
+
+##################################################
+
 # read in data and return in a numpy array
-def read_in_data(files, e=['n']*10):
-    """Reads in two or three space separated columns from a data file.
-        Returns a tuple of numpy arrays containing the x, y and error values.
+def read_in_data(files, e=None):
+    """Reads in two or three space separated columns from each data file.
+        Returns a tuple of lists, with one float64 numpy array per file, holding
+        the x, y and error values.
         The latter is only included if the argument e='y'"""
-    # initialize data
-    data = []
-    xs   = []
-    ys   = []
-    es   = []
-
-    # read in files
-    for f in files:
-        with open(f) as F:
-            data.append(F.read())
-    # parse the data
-    for i in range(len(data)):
-        # split data and get rid of the last blank row and comments
-        data[i] = data[i].split('\n')[:-1]
-        data[i] = [ row for row in data[i] if row[0] != "@" ]
-        data[i] = [ row for row in data[i] if row[0] != "#" ]
-
-        # save in x and y variables
-        data[i] = [ row.replace(',',' ').split() for row in data[i] ]
-
-        xs.append( np.asarray([float(row[0]) for row in data[i]]) )
-        ys.append( np.asarray([float(row[1]) for row in data[i]]) )
-        if e[i] == 'y':
-            try:
-                es.append( np.asarray([ float(row[2]) for row in data[i] ]) )
-            except:
-                # if no error column provided, just set to zero
-                es.append( np.asarray([0.]*len(data[i])) )
-        else:
-            es.append( np.asarray([0.]*len(data[i])) )
+    if e is None:
+        e = ['n']*len(files)
+
+    # the files are independent, so read them side by side.
+    # map keeps the results in the order of the files
+    with ThreadPoolExecutor(max_workers=min(8, len(files))) as ex:
+        data = list(ex.map(read_in_file, files, e))
+
+    xs = [ d[0] for d in data ]
+    ys = [ d[1] for d in data ]
+    es = [ d[2] for d in data ]
 
     return xs, ys, es
 
 ##################################################
        
 def scale_data( x, s ):
-    for i in range(len(x)):
-        x[i] *= s[i]
+    """Scales each array in x in place by the matching factor in s"""
+    for xi, si in zip(x, s):
+        xi *= si
     return x
 
 ##################################################
 
-# The main routine
-# get the user input
-args = get_user_args()
-
-# store the user arguments in variables
-files     = args.parse_args().files
-errplt    = args.parse_args().error if args.parse_args().error else ['n']*len(files)
-histplt   = args.parse_args().hist[0] if args.parse_args().hist else 'n'
-linewidth = args.parse_args().linewidth if args.parse_args().linewidth else [1]*len(files)
-linestyle = args.parse_args().linestyle if args.parse_args().linestyle else ['-']*len(files)
-marker    = args.parse_args().marker if args.parse_args().marker else [' ']*len(files)
-markersize= args.parse_args().markersize if args.parse_args().markersize else [3.5]*len(files)
-output    = args.parse_args().output if args.parse_args().output else None
-width     = args.parse_args().dimension[0] if args.parse_args().dimension else 3.3
-height    = args.parse_args().dimension[1] if args.parse_args().dimension else 2.5
-dpi       = 300
-xb        = args.parse_args().xb
-yb        = args.parse_args().yb
-color     = args.parse_args().color
-nolabels  = args.parse_args().nolabels[0] if args.parse_args().nolabels else 'n'
-label2    = args.parse_args().label2 if args.parse_args().label2 else None
-label2size= args.parse_args().label2size if args.parse_args().label2size else 10
-
-if not color: # default color
-    color = ['black','red','blue','green','purple','magenta','cyan','orange','yellow'][0:len(files)]
-ecolor    = args.parse_args().ecolor
-if not ecolor: # default color
-    ecolor = ['magenta','blue','cyan','green','orange','red'][0:len(files)]
-fit       = args.parse_args().fit if args.parse_args().fit else [-1]*len(files)
-labels    = args.parse_args().labels
-if not labels:  # default labels 0, 1, 2, 3 if not given by user
-    labels = range(len(files))
-xlabels   = args.parse_args().xl
-if not xlabels: # default x label
-    xlabels = ['x']
-ylabels   = args.parse_args().yl
-if not ylabels: #
-    ylabels = ['y']
-sx        = args.parse_args().sx
-sy        = args.parse_args().sy
-xtics     = args.parse_args().xtics
-ytics     = args.parse_args().ytics
-logplot   = args.parse_args().logplot[0] if args.parse_args().logplot else 'n'
-invplot   = args.parse_args().invplot[0] if args.parse_args().invplot else 'n'
-legendsize= args.parse_args().legendsize[0] if args.parse_args().legendsize else None
-
-# read the files and store data
-x, y, e = read_in_data( files, e=errplt )
-
-# if an inverse plot is requested, invert the appropriate data
-if invplot == 'x' or invplot == 'b':
-    x = 1./x
-if invplot == 'y' or invplot == 'b':
-    y = 1./y
-    e = 1./e
-
-# scale the data if requested by the user
-if sx:
-    x = scale_data( x, sx )
-if sy:
-    y = scale_data( y, sy )
-    e = scale_data( e, sy )
+def single_precision( a, pixels ):
+    """Returns a as float32 if rounding it moves no value by more than a
+        small fraction of a pixel, when its range spans the given number of
+        pixels. Otherwise returns a unchanged"""
+    with np.errstate(over='ignore'): # too large values become inf and fail
+        b = a.astype(np.float32)
+    if a.size and np.abs(b - a).max()*pixels*100 <= np.ptp(a):
+        return b
+    return a
 
 ##################################################
-# make the plots
-plt.figure(1, figsize=(width, height), dpi=dpi )
-for i in range(len(y)):
-    # error plot is a little different from regular
-    if errplt[i] =='y':
-        plt.errorbar( x[i], y[i], yerr=e[i], label=labels[i], linewidth=linewidth[i], 
-                linestyle=linestyle[i], color=color[i], fmt=marker[i], capthick=linewidth[i], 
-                barsabove=False, elinewidth=linewidth[i], ecolor=ecolor[i], 
-                markersize=markersize[i], capsize=2.5 )
-    elif histplt =='y':
-        plt.bar( x[i], y[i], color=color[i], edgecolor=ecolor[i], align='center', 
-                 width=abs(x[i][0]-x[i][1]), label=labels[i] )
-    else:
-        plt.plot( x[i], y[i], label=labels[i], linewidth=linewidth[i], linestyle=linestyle[i],
-                color=color[i], marker=marker[i], markersize=markersize[i] )
-    if fit[i] >= 0:
-        # order, must be for spline to work
-        order = np.argsort(x[i])
-        spl = interpolate.UnivariateSpline(x[i][order],y[i][order], s=fit[i])
-        xs = np.linspace( x[i].min(), x[i].max(), num=100 )
-        plt.plot( xs, spl(xs), linewidth=linewidth[i], color=color[i], linestyle='-' )
-
-# edit the plots with the appropriate labels and stuff
-
-plt.xlabel( xlabels[0], fontsize=10 )
-plt.ylabel( ylabels[0], fontsize=10)
-
-# adjust the tick size and turn on minor ticks
-plt.tick_params(axis='both',which='major',labelsize=10, direction='in',
-                top='on',bottom='on', left='on', right='on')
-plt.minorticks_on()
-plt.tick_params(axis='both',which='minor',labelsize=6, direction='in',
-                top='on',bottom='on', left='on', right='on')
-
-# if log plots are requested
-if logplot == 'x' or logplot == 'b':
-    plt.xscale('log')
-if logplot == 'y' or logplot == 'b':
-    plt.yscale('log')
-
-# set the tics if provided by the user, else use the default
-from matplotlib.ticker import MultipleLocator
-if xtics:
-    ax = plt.gca()
-    ax.xaxis.set_major_locator(MultipleLocator(xtics[0]))
-    ax.xaxis.set_minor_locator(MultipleLocator(xtics[1]))
-if ytics:
-    ax = plt.gca()
-    ax.yaxis.set_major_locator(MultipleLocator(ytics[0]))
-    ax.yaxis.set_minor_locator(MultipleLocator(ytics[1]))
-
-
-
-# adjust the area to the left and right of the plot to fit the labels
-plt.subplots_adjust(bottom=0.2,left=0.20)
-# plot the curve legend
-if nolabels != 'y':
-    if legendsize:
-        plt.legend(prop={'size':legendsize},frameon=False)
-    else:
-        plt.legend(prop={'size':10},frameon=False)
 
-# adjust window if user has added bounds
-if xb:
-   plt.xlim((xb[0],xb[1])) 
-if yb:
-   plt.ylim((yb[0],yb[1])) 
+def downsample( x, y, target ):
+    """Reduces a curve to at most about target points for plotting.
+        Keeps the smallest and largest y of each bucket of points, in file
+        order, so spikes survive. Short curves are returned unchanged"""
+    n = len(x)
+    if n <= target:
+        return x, y
+    size = -(-2*n // target) # points per bucket, rounded up
+    m    = n - n % size
+    base = np.arange(0, m, size)
+    imin = y[:m].reshape(-1, size).argmin(axis=1) + base
+    imax = y[:m].reshape(-1, size).argmax(axis=1) + base
+    # the points left over at the end make one last, shorter bucket
+    tail = [ m + y[m:].argmin(), m + y[m:].argmax() ] if m < n else []
+    idx  = np.unique( np.concatenate(( [0], imin, imax, tail, [n-1] )) ).astype(np.int64)
+    return x[idx], y[idx]
+
+##################################################
+
+# The main routine
+def main(argv=None):
+    """Plots the files given on the command line, or in argv if provided.
+        Uses the matplotlib backend already in use, if any.
+        Returns the exit status"""
+    # get the user input
+    ns = get_user_args().parse_args(argv)
+
+    # store the user arguments in variables
+    files     = ns.files
+    n         = len(files)
+    errplt    = (ns.error or ['n']*n)[:n]
+    histplt   = ns.hist[0] if ns.hist else 'n'
+    linewidth = (ns.linewidth or [1]*n)[:n]
+    linestyle = (ns.linestyle or ['-']*n)[:n]
+    marker    = (ns.marker or [' ']*n)[:n]
+    markersize= (ns.markersize or [3.5]*n)[:n]
+    output    = ns.output if ns.output else None
+    width     = ns.dimension[0] if ns.dimension else 3.3
+    height    = ns.dimension[1] if ns.dimension else 2.5
+    dpi       = 300 if output else 100 # screen resolution is enough for plt.show()
+    # a picture written as pixels can not be zoomed past its resolution,
+    # unlike a window or a vector file
+    raster    = bool(output) and os.path.splitext(output)[1].lower() in \
+                ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.webp', '.raw', '.rgba')
+    xb        = ns.xb
+    yb        = ns.yb
+    nolabels  = ns.nolabels[0] if ns.nolabels else 'n'
+    label2    = ns.label2 if ns.label2 else None
+    label2size= ns.label2size if ns.label2size else 10
+
+    # default colors
+    color     = (ns.color or ['black','red','blue','green','purple','magenta','cyan','orange','yellow'])[:n]
+    ecolor    = (ns.ecolor or ['magenta','blue','cyan','green','orange','red'])[:n]
+    fit       = (ns.fit or [-1]*n)[:n]
+    labels    = ns.labels
+    if not labels:  # default labels 0, 1, 2, 3 if not given by user
+        labels = range(n)
+    xlabels   = ns.xl
+    if not xlabels: # default x label
+        xlabels = ['x']
+    ylabels   = ns.yl
+    if not ylabels: #
+        ylabels = ['y']
+    sx        = ns.sx
+    sy        = ns.sy
+    xtics     = ns.xtics
+    ytics     = ns.ytics
+    logplot   = ns.logplot[0] if ns.logplot else 'n'
+    invplot   = ns.invplot[0] if ns.invplot else 'n'
+    legendsize= ns.legendsize[0] if ns.legendsize else None
+
+    # read the files and store data
+    x, y, e = read_in_data( files, e=errplt )
 
-# add second label, as a, b, c if desired
-if label2:
-    ax = plt.gca()
-    ax.text(0.05, 0.95, label2[0], fontsize=label2size, transform=ax.transAxes, va='top')#, fontweight='bold' )
+    # if an inverse plot is requested, invert the appropriate data
+    if invplot == 'x' or invplot == 'b':
+        x = [ 1./xi for xi in x ]
+    if invplot == 'y' or invplot == 'b':
+        y = [ 1./yi for yi in y ]
+        # only the error bars that will be plotted, the rest are all zeros
+        e = [ 1./ei if errplt[i] == 'y' else ei for i, ei in enumerate(e) ]
 
+    # scale the data if requested by the user
+    if sx:
+        x = scale_data( x, sx )
+    if sy:
+        y = scale_data( y, sy )
+        e = scale_data( e, sy )
 
-# show the figure if no output file is specified, otherwise save it
-if output == None:
-    plt.show()
-    plt.close()
-else:
-    plt.savefig(output, dpi=dpi)
+    # single precision is plenty to draw most data into a raster file and
+    # halves the memory used from here on. It is judged on the values as
+    # drawn. Data that is fitted with a spline stays in double precision,
+    # and so does an axis with user bounds, which may zoom in far enough
+    # for the rounding to show
+    if raster:
+        for i in range(n):
+            if fit[i] < 0:
+                if not xb:
+                    x[i] = single_precision( x[i], width*dpi )
+                if not yb:
+                    y[i] = single_precision( y[i], height*dpi )
+                    e[i] = single_precision( e[i], height*dpi )
+
+    ##################################################
+    # import matplotlib only now, so --help, bad arguments and
+    # unreadable files do not pay for it
+    import matplotlib
+    # no window needed, skip loading a GUI backend. Only on the first import
+    # of pyplot, a backend already in use belongs to the caller
+    if output and 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import MultipleLocator
+    # draw very long paths in pieces rather than overflowing Agg
+    matplotlib.rcParams['agg.path.chunksize'] = 10000
+
+    # make the plots
+    plt.figure(1, figsize=(width, height), dpi=dpi )
+
+    # a line written to a raster file only needs a couple of points per
+    # pixel across the figure. The buckets are taken in index space over
+    # the whole curve, so they only match pixels on a linear x axis that
+    # shows all of the data
+    target = int(width*dpi*2)
+    thin   = raster and not xb and logplot not in ('x','b')
+
+    # if every file is a plain line plot on the same, short enough, x values,
+    # draw all of the curves with a single call
+    batch = histplt != 'y' and all( errplt[i] != 'y' for i in range(len(y)) ) and \
+            (not thin or len(x[0]) <= target) and \
+            all( np.array_equal(xi, x[0]) for xi in x[1:] )
+    if batch:
+        lines = plt.plot( x[0], np.column_stack(y) )
+        for i, line in enumerate(lines):
+            line.set( label=labels[i], linewidth=linewidth[i], linestyle=linestyle[i],
+                      color=color[i], marker=marker[i], markersize=markersize[i] )
+
+    for i in range(len(y)):
+        # error plot is a little different from regular
+        if errplt[i] =='y':
+            plt.errorbar( x[i], y[i], yerr=e[i], label=labels[i], linewidth=linewidth[i], 
+                    linestyle=linestyle[i], color=color[i], fmt=marker[i], capthick=linewidth[i], 
+                    barsabove=False, elinewidth=linewidth[i], ecolor=ecolor[i], 
+                    markersize=markersize[i], capsize=2.5 )
+        elif histplt =='y':
+            plt.bar( x[i], y[i], color=color[i], edgecolor=ecolor[i], align='center', 
+                     width=abs(x[i][0]-x[i][1]), label=labels[i] )
+        elif not batch:
+            # thin out long curves, unless each point is drawn with a marker
+            if thin and not marker[i].strip():
+                xp, yp = downsample( x[i], y[i], target )
+            else:
+                xp, yp = x[i], y[i]
+            plt.plot( xp, yp, label=labels[i], linewidth=linewidth[i], linestyle=linestyle[i],
+                    color=color[i], marker=marker[i], markersize=markersize[i] )
+        if fit[i] >= 0:
+            # order, must be for spline to work. Most data already is,
+            # so only sort when a single scan says it is needed
+            x_sorted, y_sorted = x[i], y[i]
+            if not (np.diff(x_sorted) >= 0).all():
+                order = np.argsort(x_sorted)
+                x_sorted, y_sorted = x_sorted[order], y_sorted[order]
+            # smoothing spline, evaluated on the whole grid at once
+            spl = interpolate.BSpline( *interpolate.splrep(x_sorted, y_sorted, s=fit[i]) )
+            # sorted, so the bounds are the end points
+            xs = np.linspace( x_sorted[0], x_sorted[-1], num=100 )
+            plt.plot( xs, spl(xs), linewidth=linewidth[i], color=color[i], linestyle='-' )
+
+    # edit the plots with the appropriate labels and stuff
+
+    plt.xlabel( xlabels[0], fontsize=10 )
+    plt.ylabel( ylabels[0], fontsize=10)
+
+    # adjust the tick size and turn on minor ticks
+    plt.tick_params(axis='both',which='major',labelsize=10, direction='in',
+                    top='on',bottom='on', left='on', right='on')
+    plt.minorticks_on()
+    plt.tick_params(axis='both',which='minor',labelsize=6, direction='in',
+                    top='on',bottom='on', left='on', right='on')
+
+    # if log plots are requested
+    if logplot == 'x' or logplot == 'b':
+        plt.xscale('log')
+    if logplot == 'y' or logplot == 'b':
+        plt.yscale('log')
+
+    # set the tics if provided by the user, else use the default
+    if xtics:
+        ax = plt.gca()
+        ax.xaxis.set_major_locator(MultipleLocator(xtics[0]))
+        ax.xaxis.set_minor_locator(MultipleLocator(xtics[1]))
+    if ytics:
+        ax = plt.gca()
+        ax.yaxis.set_major_locator(MultipleLocator(ytics[0]))
+        ax.yaxis.set_minor_locator(MultipleLocator(ytics[1]))
+
+
+
+    # adjust the area to the left and right of the plot to fit the labels
+    plt.subplots_adjust(bottom=0.2,left=0.20)
+    # plot the curve legend
+    if nolabels != 'y':
+        if legendsize:
+            plt.legend(prop={'size':legendsize},frameon=False)
+        else:
+            plt.legend(prop={'size':10},frameon=False)
+
+    # adjust window if user has added bounds
+    if xb:
+       plt.xlim((xb[0],xb[1])) 
+    if yb:
+       plt.ylim((yb[0],yb[1])) 
+
+    # add second label, as a, b, c if desired
+    if label2:
+        ax = plt.gca()
+        ax.text(0.05, 0.95, label2[0], fontsize=label2size, transform=ax.transAxes, va='top')#, fontweight='bold' )
+
+
+    # show the figure if no output file is specified, otherwise save it
+    if output == None:
+        plt.show()
+        plt.close()
+    else:
+        plt.savefig(output, dpi=dpi)
+        plt.close()
+
+    return 0
+
+##################################################
 
-# exit
-exit()
+if __name__ == '__main__':
+    sys.exit(main())